@@ -1,12 +1,22 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
+import orjson
 import pandas as pd
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 import time
+import threading
+import atexit
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import io
+import xxhash
+
+logger = logging.getLogger(__name__)
 
 # Configuration de la page
 st.set_page_config(
@@ -21,6 +31,20 @@ AIRTABLE_TOKEN = st.secrets["AIRTABLE_TOKEN"]
 AUTH_BASE_ID = st.secrets["AUTH_BASE_ID"]
 LOGS_BASE_ID = st.secrets["LOGS_BASE_ID"]
 TABLE_NAME = st.secrets["TABLE_NAME"]
+DISPLAY_MAX_SIZE = (800, 800)  # Taille maximale des images affichées
+AIRTABLE_BATCH_SIZE = 10  # Nombre maximum d'enregistrements par requête Airtable
+ENHANCE_MAX_WORKERS = 32  # Appels simultanés à l'API d'amélioration, pour tout le serveur
+POLL_INTERVAL = 0.5  # Intervalle (secondes) de suivi d'un traitement en cours
+LOG_FLUSH_INTERVAL = 30  # Délai maximum (secondes) avant l'envoi des logs en attente
+LOG_BUFFER_MAX_SIZE = 1000  # Nombre maximum de logs conservés en attente d'envoi
+
+class AirtableRetry(Retry):
+    """Politique de réessai Airtable : POST n'étant pas idempotent, il n'est
+    réessayé que sur 429 (requête refusée avant toute écriture)"""
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST":
+            return status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
 
 class AirtableClient:
     def __init__(self, token, base_id, table_name):
@@ -32,104 +56,271 @@ class AirtableClient:
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
         }
+        # Session persistante : réutilise la connexion TLS (keep-alive)
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # Réessayer avec backoff exponentiel sur les erreurs transitoires (429/5xx ;
+        # 429 seulement pour POST, voir AirtableRetry)
+        retry = AirtableRetry(
+            total=4,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "PATCH"]
+        )
+        self.session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+        )
     
-    def get_records(self, filter_formula=None):
-        """Récupérer les enregistrements d'une table"""
+    def get_records(self, filter_formula=None, fields=None, max_records=None, raise_errors=False):
+        """Récupérer les enregistrements d'une table
+
+        Avec raise_errors=True, les erreurs réseau/HTTP sont propagées au lieu
+        d'être affichées et converties en liste vide.
+        """
         url = self.base_url
         params = {}
         if filter_formula:
             params["filterByFormula"] = filter_formula
+        if fields:
+            params["fields[]"] = list(fields)
+        if max_records:
+            params["maxRecords"] = max_records
         
         try:
-            response = requests.get(url, headers=self.headers, params=params)
+            response = self.session.get(url, params=params)
             response.raise_for_status()
             return response.json().get("records", [])
         except requests.exceptions.RequestException as e:
+            if raise_errors:
+                raise
             st.error(f"Erreur lors de la récupération des données: {e}")
             return []
     
+    def get_record(self, record_id, raise_errors=False):
+        """Récupérer un enregistrement par son identifiant"""
+        url = f"{self.base_url}/{record_id}"
+        
+        try:
+            response = self.session.get(url)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            if raise_errors:
+                raise
+            st.error(f"Erreur lors de la récupération de l'enregistrement: {e}")
+            return None
+    
     def create_record(self, fields):
         """Créer un nouvel enregistrement"""
         url = self.base_url
         data = {"fields": fields}
         
         try:
-            response = requests.post(url, headers=self.headers, json=data)
+            response = self.session.post(url, json=data)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             st.error(f"Erreur lors de la création de l'enregistrement: {e}")
             return None
     
-    def update_record(self, record_id, fields):
+    def create_records(self, fields_list, raise_errors=False):
+        """Créer plusieurs enregistrements (par lots de 10, limite Airtable)
+
+        Avec raise_errors=True, la première erreur réseau/HTTP est propagée au lieu
+        d'être affichée.
+        """
+        url = self.base_url
+        created = []
+        
+        for i in range(0, len(fields_list), AIRTABLE_BATCH_SIZE):
+            batch = fields_list[i:i + AIRTABLE_BATCH_SIZE]
+            data = {"records": [{"fields": fields} for fields in batch]}
+            
+            try:
+                response = self.session.post(url, json=data)
+                response.raise_for_status()
+                created.extend(response.json().get("records", []))
+            except requests.exceptions.RequestException as e:
+                if raise_errors:
+                    raise
+                st.error(f"Erreur lors de la création des enregistrements: {e}")
+        
+        return created
+    
+    def update_record(self, record_id, fields, raise_errors=False):
         """Mettre à jour un enregistrement existant"""
         url = f"{self.base_url}/{record_id}"
         data = {"fields": fields}
         
         try:
-            response = requests.patch(url, headers=self.headers, json=data)
+            response = self.session.patch(url, json=data)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
+            if raise_errors:
+                raise
             st.error(f"Erreur lors de la mise à jour: {e}")
             return None
 
+class LogBuffer:
+    """Tampon de logs partagé par tout le processus, envoyé par lots à Airtable
+
+    Un thread d'arrière-plan envoie les logs dès qu'un lot complet est disponible,
+    ou au plus tard toutes les flush_interval secondes ; le reste est envoyé à l'arrêt.
+    Les lots en échec sont remis en attente (dans la limite de LOG_BUFFER_MAX_SIZE)
+    et les erreurs sont journalisées via logging, faute de session Streamlit.
+    """
+    def __init__(self, client, flush_interval):
+        self.client = client
+        self.entries = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        
+        thread = threading.Thread(target=self._run, args=(flush_interval,), daemon=True)
+        thread.start()
+        atexit.register(self.flush)
+    
+    def append(self, entry):
+        """Ajouter une entrée et réveiller le thread si un lot est complet"""
+        with self.lock:
+            self.entries.append(entry)
+            batch_ready = len(self.entries) >= AIRTABLE_BATCH_SIZE
+        
+        if batch_ready:
+            self.wakeup.set()
+    
+    def flush(self):
+        """Envoyer toutes les entrées en attente"""
+        with self.lock:
+            entries, self.entries = self.entries, []
+        
+        for i in range(0, len(entries), AIRTABLE_BATCH_SIZE):
+            try:
+                self.client.create_records(entries[i:i + AIRTABLE_BATCH_SIZE], raise_errors=True)
+            except requests.exceptions.RequestException as e:
+                logger.warning(
+                    "Échec de l'envoi de %d logs à Airtable, nouvel essai au prochain envoi: %s",
+                    len(entries) - i, e
+                )
+                self._requeue(entries[i:])
+                return
+    
+    def _requeue(self, entries):
+        """Remettre des entrées non envoyées en tête du tampon, en abandonnant les plus anciennes si plein"""
+        with self.lock:
+            self.entries = entries + self.entries
+            overflow = len(self.entries) - LOG_BUFFER_MAX_SIZE
+            if overflow > 0:
+                del self.entries[:overflow]
+        
+        if overflow > 0:
+            logger.error("Tampon de logs plein : %d logs les plus anciens abandonnés", overflow)
+    
+    def _run(self, flush_interval):
+        while True:
+            self.wakeup.wait(flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Ne jamais laisser mourir le thread d'envoi
+                logger.exception("Erreur inattendue lors de l'envoi des logs à Airtable")
+
+@st.cache_resource
 def initialize_auth_client():
     """Initialiser le client Airtable pour l'authentification"""
     return AirtableClient(AIRTABLE_TOKEN, AUTH_BASE_ID, TABLE_NAME)
 
+@st.cache_resource
 def initialize_logs_client():
     """Initialiser le client Airtable pour les logs"""
     return AirtableClient(AIRTABLE_TOKEN, LOGS_BASE_ID, TABLE_NAME)
 
-def check_api_key_credits(api_key):
-    """Vérifier les crédits restants pour une clé API"""
+@st.cache_resource
+def initialize_log_buffer():
+    """Initialiser le tampon de logs partagé entre les sessions"""
+    return LogBuffer(initialize_logs_client(), LOG_FLUSH_INTERVAL)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _lookup_key(api_key):
+    """Rechercher une clé API dans Airtable (mis en cache 60 s par clé)
+
+    Retourne (record_id, used, allowed) ou None si la clé n'existe pas.
+    Les erreurs d'accès à Airtable sont propagées pour ne pas être mises en cache.
+    """
     client = initialize_auth_client()
     
     # Rechercher la clé API dans Airtable
     filter_formula = f"{{API_KEY}} = '{api_key}'"
-    records = client.get_records(filter_formula)
+    records = client.get_records(
+        filter_formula,
+        fields=["Used_credits", "Allowed_credits"],
+        max_records=1,
+        raise_errors=True
+    )
     
     if not records:
-        return None, "Clé API non trouvée"
+        return None
     
     record = records[0]
     fields = record["fields"]
-    used = fields.get("Used_credits", 0)
-    allowed = fields.get("Allowed_credits", 0)
+    return record["id"], fields.get("Used_credits", 0), fields.get("Allowed_credits", 0)
+
+def check_api_key_credits(api_key):
+    """Vérifier les crédits restants pour une clé API
+
+    Retourne (ok, message, record_id, used, allowed).
+    """
+    try:
+        lookup = _lookup_key(api_key)
+    except requests.exceptions.RequestException as e:
+        return None, f"Vérification des crédits impossible, réessayez plus tard ({e})", None, None, None
+    
+    if lookup is None:
+        return None, "Clé API non trouvée", None, None, None
+    
+    record_id, used, allowed = lookup
     remaining = allowed - used
     
     if remaining <= 0:
-        return False, f"Plus de crédits restants (utilisés: {used}/{allowed})"
+        return False, f"Plus de crédits restants (utilisés: {used}/{allowed})", record_id, used, allowed
+    
+    return True, f"{remaining} crédits restants (utilisés: {used}/{allowed})", record_id, used, allowed
+
+def validate_api_key(api_key):
+    """Vérifier une clé API et mémoriser le résultat dans la session"""
+    credits_ok, credits_msg, record_id, _, _ = check_api_key_credits(api_key)
     
-    return True, f"{remaining} crédits restants (utilisés: {used}/{allowed})"
+    st.session_state["_auth"] = {
+        "api_key": api_key,
+        "ok": credits_ok,
+        "msg": credits_msg
+    }
+    st.session_state["_credit_row"] = record_id
 
-def update_credits(api_key, increment=1):
-    """Incrémenter les crédits utilisés d'une clé API"""
+def update_credits(api_key, record_id, increment=1):
+    """Incrémenter les crédits utilisés d'une clé API déjà identifiée
+
+    Les erreurs Airtable sont propagées : cette fonction tourne hors du thread du script,
+    l'appelant doit les remonter à l'utilisateur.
+    """
     client = initialize_auth_client()
     
-    # Rechercher la clé API
-    filter_formula = f"{{API_KEY}} = '{api_key}'"
-    records = client.get_records(filter_formula)
+    # Relire le compteur juste avant l'écriture (il a pu changer depuis la vérification)
+    record = client.get_record(record_id, raise_errors=True)
     
-    if records:
-        record = records[0]
-        current_used = record["fields"].get("Used_credits", 0)
-        new_used = current_used + increment
-        
-        # Mettre à jour l'enregistrement
-        client.update_record(
-            record["id"], 
-            {"Used_credits": new_used}
-        )
-
-def log_api_call(api_key, status, original_size=None, output_size=None,
-                scale=None, format_type=None, processing_time=None, error_message=None):
-    """Enregistrer un appel API dans les logs Airtable"""
-    client = initialize_logs_client()
+    new_used = record["fields"].get("Used_credits", 0) + increment
+    client.update_record(record_id, {"Used_credits": new_used}, raise_errors=True)
     
-    log_entry = {
-        "timestamp": datetime.now().isoformat(),
+    # Invalider le cache de cette clé pour que la prochaine lecture voie le nouveau compteur
+    _lookup_key.clear(api_key)
+
+def _mk_log(ts, api_key, status, original_size=None, output_size=None,
+            scale=None, format_type=None, processing_time=None, error_message=None):
+    """Construire une entrée de log au format de la table Airtable"""
+    return {
+        "timestamp": ts,
         "api_key": api_key,
         "status": status,
         "original_size": str(original_size) if original_size else None,
@@ -139,33 +330,53 @@ def log_api_call(api_key, status, original_size=None, output_size=None,
         "processing_time": processing_time,
         "error_message": error_message
     }
+
+def log_api_call(api_key, status, **kwargs):
+    """Ajouter un appel API au tampon de logs (envoyé par lots à Airtable)"""
+    # Horodatage UTC à la seconde (pas de fuseau local ni de microsecondes à formater)
+    ts = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    log_entry = _mk_log(ts, api_key, status, **kwargs)
     
-    client.create_record(log_entry)
+    initialize_log_buffer().append(log_entry)
+
+@st.cache_resource
+def _pool():
+    """Pool de threads partagé entre les sessions pour les appels à l'API d'amélioration"""
+    return ThreadPoolExecutor(max_workers=ENHANCE_MAX_WORKERS)
 
-def enhance_image(image_data, api_key, scale=4, format_type="JPEG"):
-    """Appeler l'API pour améliorer une image"""
+def enhance_image(image_data, api_key, record_id, scale=4, format_type="JPEG", mime_type="image/jpeg"):
+    """Appeler l'API pour améliorer une image
+
+    record_id est l'enregistrement Airtable de la clé, dont les crédits sont décomptés.
+    Exécutée dans le pool, sans contexte Streamlit : aucun appel st.* ne doit s'y afficher,
+    les erreurs sont renvoyées dans le résultat.
+    """
     start_time = time.time()
     
     try:
-        # Encoder l'image en base64
-        image_b64 = base64.b64encode(image_data).decode()
-        
-        # Préparer la requête
-        payload = {
-            "image": image_b64,
-            "scale": scale,
-            "format": format_type
-        }
+        # Envoyer l'image brute en multipart (pas d'encodage base64 côté client)
+        files = {"image": ("img", image_data, mime_type)}
+        data = {"scale": scale, "format": format_type}
         
         # Faire l'appel API
-        response = requests.post(API_URL, json=payload, timeout=300)
+        response = requests.post(API_URL, files=files, data=data, timeout=300)
         processing_time = round(time.time() - start_time, 2)
         
         if response.status_code == 200:
-            result = response.json()
+            # Parser directement les octets avec orjson (plus rapide sur la grosse chaîne base64)
+            result = orjson.loads(response.content)
+            # Libérer le corps brut de la réponse avant de décoder l'image
+            del response
             if result.get("success"):
-                # Décoder l'image de sortie
-                output_data = base64.b64decode(result["output_image"])
+                # Décoder l'image de sortie en retirant la chaîne base64 du résultat,
+                # pour ne pas la conserver dans st.session_state.result
+                output_data = base64.b64decode(result.pop("output_image"))
+                
+                # Dimensions lues localement (en-têtes seulement) plutôt que renvoyées par le serveur ;
+                # à défaut, on garde la valeur du serveur : cela ne doit jamais faire échouer l'appel
+                for key, data in (("original_size", image_data), ("output_size", output_data)):
+                    size = _header_size(data)
+                    result[key] = f"{size[0]}x{size[1]}" if size else result.get(key, "N/A")
                 
                 # Log du succès
                 log_api_call(
@@ -178,8 +389,14 @@ def enhance_image(image_data, api_key, scale=4, format_type="JPEG"):
                     processing_time=processing_time
                 )
                 
-                # Décrémenter les crédits
-                update_credits(api_key)
+                # Décrémenter les crédits (les logs partent en arrière-plan) ; un échec est
+                # renvoyé dans le résultat pour être affiché par le thread du script
+                if record_id:
+                    try:
+                        update_credits(api_key, record_id)
+                    except requests.exceptions.RequestException as e:
+                        logger.error("Échec du décompte du crédit pour %s: %s", record_id, e)
+                        result["credit_error"] = str(e)
                 
                 return True, output_data, result
             else:
@@ -218,6 +435,42 @@ def enhance_image(image_data, api_key, scale=4, format_type="JPEG"):
         )
         return False, None, {"error": error_msg}
 
+def _header_size(data):
+    """Lire (largeur, hauteur) depuis l'en-tête d'une image, ou None si elle est illisible
+
+    Les très grandes images (au-delà de Image.MAX_IMAGE_PIXELS) sont aussi refusées par
+    Pillow dès l'ouverture ; on renvoie alors None plutôt que de lever l'erreur.
+    """
+    try:
+        return Image.open(io.BytesIO(data)).size
+    except (OSError, Image.DecompressionBombError):
+        return None
+
+def _make_thumbnail(image):
+    """Réduire une image ouverte à la taille d'affichage (évite d'envoyer la pleine résolution au navigateur)"""
+    image.thumbnail(DISPLAY_MAX_SIZE, Image.Resampling.LANCZOS)
+    return image
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _display_thumbnail(data):
+    """Miniature d'affichage de l'image améliorée
+
+    Seule la miniature est mise en cache, jamais l'image décodée en pleine résolution.
+    """
+    return _make_thumbnail(Image.open(io.BytesIO(data)))
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def render_panel(file_bytes, scale):
+    """Préparer la miniature, la légende et le texte d'information de l'image d'origine
+
+    Seul niveau de cache pour ce panneau : l'image n'est hachée et ouverte qu'une fois.
+    """
+    image = Image.open(io.BytesIO(file_bytes))
+    width, height = image.size
+    caption = f"Image originale ({width}x{height})"
+    info = f"📐 Taille actuelle: {width}x{height} → Nouvelle taille: {width * scale}x{height * scale} pixels"
+    return _make_thumbnail(image), caption, info
+
 def get_correct_filename(original_filename, scale, format_type):
     """Génère le nom de fichier correct avec la bonne extension"""
     # Extraire le nom sans extension
@@ -236,16 +489,32 @@ def main():
     # Section configuration au-dessus des colonnes
     st.header("⚙️ Configuration")
     
-    # Saisie de la clé API par le client
-    api_key = st.text_input("🔑 Clé API", type="password", help="Entrez votre clé API personnelle")
+    # Un traitement en cours verrouille les paramètres jusqu'à récupération du résultat
+    processing = "_pending" in st.session_state
+    
+    # Saisie de la clé API par le client (vérifiée seulement à la validation du formulaire)
+    with st.form("auth"):
+        api_key_input = st.text_input("🔑 Clé API", type="password", help="Entrez votre clé API personnelle")
+        submitted = st.form_submit_button("Valider", disabled=processing)
+    
+    if submitted:
+        if api_key_input:
+            validate_api_key(api_key_input)
+        else:
+            st.session_state.pop("_auth", None)
+            st.session_state["_credit_row"] = None
     
-    if not api_key:
-        st.warning("⚠️ Veuillez entrer votre clé API pour continuer")
+    auth = st.session_state.get("_auth")
+    if not auth:
+        st.warning("⚠️ Veuillez entrer et valider votre clé API pour continuer")
         return
     
-    # Vérifier les crédits seulement si aucune image n'a été traitée avec succès
+    api_key = auth["api_key"]
+    credits_ok = auth["ok"]
+    credits_msg = auth["msg"]
+    
+    # Bloquer seulement si aucune image n'a été traitée avec succès
     if not st.session_state.get('image_processed', False):
-        credits_ok, credits_msg = check_api_key_credits(api_key)
         if credits_ok:
             st.success(f"✅ {credits_msg}")
         elif credits_ok is False:
@@ -256,7 +525,6 @@ def main():
             return
     else:
         # Si une image a été traitée, afficher juste un message informatif sur les crédits
-        credits_ok, credits_msg = check_api_key_credits(api_key)
         if credits_ok is False:
             st.warning(f"⚠️ {credits_msg} - Vous pouvez encore voir votre dernière image générée ci-dessous")
         elif credits_ok:
@@ -268,7 +536,8 @@ def main():
     uploaded_file = st.file_uploader(
         "Choisir une image",
         type=["jpg", "jpeg", "png"],
-        help="Formats supportés: JPG, PNG"
+        help="Formats supportés: JPG, PNG",
+        disabled=processing
     )
     
     if uploaded_file is None:
@@ -279,16 +548,14 @@ def main():
     col_param1, col_param2 = st.columns(2)
     
     with col_param1:
-        scale = st.selectbox("Facteur d'agrandissement", [2, 4, 8], index=1)
+        scale = st.selectbox("Facteur d'agrandissement", [2, 4, 8], index=1, disabled=processing)
     
     with col_param2:
-        format_type = st.selectbox("Format de sortie", ["JPEG", "PNG"], index=0)
+        format_type = st.selectbox("Format de sortie", ["JPEG", "PNG"], index=0, disabled=processing)
     
     # Information sur le résultat attendu
-    image = Image.open(uploaded_file)
-    new_width = image.size[0] * scale
-    new_height = image.size[1] * scale
-    st.info(f"📐 Taille actuelle: {image.size[0]}x{image.size[1]} → Nouvelle taille: {new_width}x{new_height} pixels")
+    thumbnail, caption, info = render_panel(uploaded_file.getvalue(), scale)
+    st.info(info)
     
     st.markdown("---")
     
@@ -298,7 +565,7 @@ def main():
     with col1:
         st.header("📤 Image d'origine")
         # Afficher l'image originale
-        st.image(image, caption=f"Image originale ({image.size[0]}x{image.size[1]})")
+        st.image(thumbnail, caption=caption)
     
     with col2:
         st.header("📥 Image améliorée")
@@ -310,55 +577,82 @@ def main():
             st.session_state.result = None
             st.session_state.processing_time = None
         
-        # Réinitialiser si nouvelle image uploadée
-        if uploaded_file and hasattr(st.session_state, 'last_uploaded_file'):
-            if st.session_state.last_uploaded_file != uploaded_file.name:
+        # Réinitialiser si nouvelle image uploadée (comparaison sur le contenu, pas le nom)
+        file_key = xxhash.xxh64_intdigest(uploaded_file.getvalue())
+        if "_file_key" in st.session_state:
+            if st.session_state["_file_key"] != file_key:
                 st.session_state.image_processed = False
                 st.session_state.output_data = None
                 st.session_state.result = None
                 st.session_state.processing_time = None
         
-        if uploaded_file:
-            st.session_state.last_uploaded_file = uploaded_file.name
+        st.session_state["_file_key"] = file_key
         
         # Afficher le bouton seulement si pas encore traité
         if not st.session_state.image_processed:
-            if st.button("✨ Améliorer l'image", type="primary"):
-                with st.spinner("Traitement en cours..."):
-                    # Démarrer le chronomètre
-                    start_time = time.time()
-                    
-                    # Convertir l'image en bytes
-                    img_bytes = uploaded_file.getvalue()
-                    
-                    # Appeler l'API
-                    success, output_data, result = enhance_image(
-                        img_bytes, api_key, scale, format_type
-                    )
-                    
-                    # Calculer le temps de traitement
-                    processing_time = round(time.time() - start_time, 2)
+            pending = st.session_state.get("_pending")
+            if pending:
+                # Le traitement tourne dans le pool et survit aux reruns : on le suit ici
+                # jusqu'à ce que son résultat (déjà payé) soit récupéré
+                if not pending["future"].done():
+                    st.info(f"⏳ Traitement en cours depuis {round(time.time() - pending['start_time'])}s...")
+                    time.sleep(POLL_INTERVAL)
+                    st.rerun()
+                
+                del st.session_state["_pending"]
+                success, output_data, result = pending["future"].result()
+                
+                # Calculer le temps de traitement
+                processing_time = round(time.time() - pending["start_time"], 2)
+                
+                if success:
+                    # Rafraîchir les crédits affichés après consommation
+                    validate_api_key(api_key)
                     
-                    if success:
-                        # Sauvegarder dans session state
-                        st.session_state.image_processed = True
-                        st.session_state.output_data = output_data
-                        st.session_state.result = result
-                        st.session_state.processing_time = processing_time
-                        st.rerun()
-                    else:
-                        st.error(f"❌ Erreur lors du traitement: {result.get('error', 'Erreur inconnue')}")
+                    # Sauvegarder dans session state
+                    st.session_state.image_processed = True
+                    st.session_state.output_data = output_data
+                    st.session_state.result = result
+                    st.session_state.processing_time = processing_time
+                else:
+                    # Afficher l'erreur au prochain run, avec les paramètres réactivés
+                    st.session_state["_last_error"] = result.get('error', 'Erreur inconnue')
+                st.rerun()
+            
+            last_error = st.session_state.pop("_last_error", None)
+            if last_error:
+                st.error(f"❌ Erreur lors du traitement: {last_error}")
+            
+            if st.button("✨ Améliorer l'image", type="primary"):
+                # Revérifier les crédits à jour : ils ont pu être consommés ailleurs
+                _lookup_key.clear(api_key)
+                validate_api_key(api_key)
+                if not st.session_state["_auth"]["ok"]:
+                    st.error(f"❌ {st.session_state['_auth']['msg']}")
+                    return
+                
+                # Appeler l'API dans le pool de threads ; le résultat est récupéré aux reruns suivants
+                future = _pool().submit(
+                    enhance_image, uploaded_file.getvalue(), api_key, st.session_state["_credit_row"],
+                    scale, format_type, uploaded_file.type
+                )
+                st.session_state["_pending"] = {"future": future, "start_time": time.time()}
+                st.rerun()
         else:
-            # Afficher l'image améliorée si déjà traitée
-            output_image = Image.open(io.BytesIO(st.session_state.output_data))
-            st.image(
-                output_image,
-                caption=f"Image améliorée ({st.session_state.result.get('output_size', 'N/A')})"
-            )
+            # Afficher l'image améliorée si déjà traitée (l'aperçu peut échouer sur de très
+            # grandes images ; le téléchargement reste disponible)
+            caption = f"Image améliorée ({st.session_state.result.get('output_size', 'N/A')})"
+            try:
+                st.image(_display_thumbnail(st.session_state.output_data), caption=caption)
+            except (OSError, Image.DecompressionBombError):
+                st.warning(f"⚠️ Aperçu indisponible pour cette image - {caption}")
             
             # Générer le nom de fichier avec la bonne extension
             filename = get_correct_filename(uploaded_file.name, scale, format_type)
             
+            if st.session_state.result.get("credit_error"):
+                st.warning(f"⚠️ Le décompte du crédit a échoué: {st.session_state.result['credit_error']}")
+            
             # Bouton de téléchargement
             st.download_button(
                 label="💾 Télécharger l'image améliorée",